@@ -22,6 +22,8 @@
 
 import sys
 import os
+import io
+import re
 import datetime
 import json
 import time
@@ -29,12 +31,16 @@ import random
 import telepot
 import subprocess
 import shelve
+import sqlite3
 import urllib3
 import threading
 import queue
+import concurrent.futures
 import shutil
+import traceback
 import pygame
 import pygame.mixer
+from collections import OrderedDict
 from tempfile import mkstemp
 from telepot.namedtuple import InlineKeyboardMarkup, InlineKeyboardButton
 from telepot.delegate import per_chat_id_in, create_open, pave_event_space, include_callback_query_chat_id
@@ -52,6 +58,10 @@ APPVERSION = '1.1.0'
 TELEGRAM_AUDIO_BITRATE = 48000
 TELEGRAM_MAX_MESSAGE_SIZE = 2048
 TELEGRAM_MAX_PHOTO_DIMENSION = 1280
+THUMBNAIL_DIMENSION = 160
+HISTORY_PAGE_SIZE = 8
+HISTORY_MAX_QUERIES = 20
+CAMERA_PROBE_TICK_SECS = 5
 
 class easydict(dict):
     def __missing__(self, key):
@@ -59,6 +69,201 @@ class easydict(dict):
         return self[key]
 
 
+class SoundCache(object):
+    """ LRU cache of decoded sounds, bounded by the total size of their PCM data """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.sounds = OrderedDict()
+
+    def get(self, key):
+        entry = self.sounds.get(key)
+        if entry is None:
+            return None
+        self.sounds.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, sound, n_bytes):
+        if key in self.sounds:
+            self.total_bytes -= self.sounds.pop(key)[1]
+        if n_bytes > self.max_bytes:
+            return
+        self.sounds[key] = (sound, n_bytes)
+        self.total_bytes += n_bytes
+        while self.total_bytes > self.max_bytes:
+            _, (_, evicted_bytes) = self.sounds.popitem(last=False)
+            self.total_bytes -= evicted_bytes
+
+
+class CameraHealth(object):
+    """ Latency and failure statistics of a camera, guarded by a circuit breaker """
+
+    FailureThreshold = 3
+    MinBackoffSecs = 15
+    MaxBackoffSecs = 15 * 60
+    Smoothing = 0.3
+
+    def __init__(self, probe_interval):
+        self.lock = threading.Lock()
+        self.probe_interval = probe_interval
+        self.latency = None
+        self.failure_rate = 0.0
+        self.consecutive_failures = 0
+        self.last_error = None
+        self.in_flight = 0
+        self.open_until = None
+        self.next_probe = time.time()
+
+    def is_open(self):
+        return self.open_until is not None
+
+    def is_busy(self):
+        return self.in_flight > 0
+
+    def acquire(self):
+        """ Returns True if a request to the camera may be made now. While the breaker is open,
+        no request is let through until the backoff has elapsed; then a single trial request is allowed. """
+        with self.lock:
+            if self.open_until is not None and (time.time() < self.open_until or self.in_flight > 0):
+                return False
+            self.in_flight += 1
+            return True
+
+    def probe_due(self):
+        return self.probe_interval > 0 and time.time() >= self.next_probe
+
+    def record_success(self, latency):
+        with self.lock:
+            self.in_flight -= 1
+            self.latency = latency if self.latency is None \
+                else (1 - CameraHealth.Smoothing) * self.latency + CameraHealth.Smoothing * latency
+            self.failure_rate *= 1 - CameraHealth.Smoothing
+            self.consecutive_failures = 0
+            self.open_until = None
+            self.next_probe = time.time() + self.probe_interval
+
+    def record_failure(self, error):
+        with self.lock:
+            self.in_flight -= 1
+            self.failure_rate = (1 - CameraHealth.Smoothing) * self.failure_rate + CameraHealth.Smoothing
+            self.consecutive_failures += 1
+            self.last_error = error
+            backoff = min(CameraHealth.MaxBackoffSecs,
+                          CameraHealth.MinBackoffSecs *
+                          2 ** max(0, self.consecutive_failures - CameraHealth.FailureThreshold))
+            if self.consecutive_failures >= CameraHealth.FailureThreshold:
+                self.open_until = time.time() + backoff
+                self.next_probe = self.open_until
+            else:
+                self.next_probe = time.time() + min(backoff, self.probe_interval)
+
+    def describe(self):
+        details = []
+        if self.latency is not None:
+            details.append('Latenz {:.0f} ms'.format(1000 * self.latency))
+        details.append('Fehlerquote {:.0f} %'.format(100 * self.failure_rate))
+        if self.is_open():
+            status = chr(0x274C) + ' offline, nächster Versuch um {}'.format(
+                datetime.datetime.fromtimestamp(self.open_until).strftime('%H:%M:%S'))
+        elif self.consecutive_failures > 0:
+            status = chr(0x26A0) + chr(0xFE0F) + ' gestört ({} Fehler in Folge)'.format(self.consecutive_failures)
+        elif self.latency is None:
+            status = chr(0x2754) + ' noch nicht geprüft'
+        else:
+            status = chr(0x2705) + ' online'
+        if self.consecutive_failures > 0 and self.last_error:
+            details.append('letzter Fehler: {}'.format(self.last_error))
+        return '{} ({})'.format(status, ', '.join(details))
+
+
+class EventIndex(object):
+    """ SQLite index of all files that arrived in the upload folder """
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS events ('
+                        'id INTEGER PRIMARY KEY, '
+                        'camera TEXT, '
+                        'timestamp REAL NOT NULL, '
+                        'media_type TEXT NOT NULL, '
+                        'filename TEXT, '
+                        'file_id TEXT, '
+                        'thumbnail BLOB)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS events_by_time ON events (timestamp)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS events_by_camera ON events (camera, timestamp)')
+        self.db.commit()
+
+    @staticmethod
+    def where(camera, since, until):
+        clause = 'timestamp >= ? AND timestamp < ?'
+        params = [since, until]
+        if camera is not None:
+            clause += ' AND camera = ?'
+            params.append(camera)
+        return clause, params
+
+    def add(self, camera, media_type, filename, thumbnail=None):
+        with self.lock:
+            cursor = self.db.execute('INSERT INTO events (camera, timestamp, media_type, filename, thumbnail) '
+                                     'VALUES (?, ?, ?, ?, ?)',
+                                     (camera, time.time(), media_type, filename, thumbnail))
+            self.db.commit()
+            return cursor.lastrowid
+
+    def set_file_id(self, event_id, file_id, media_type):
+        with self.lock:
+            self.db.execute('UPDATE events SET file_id = ?, media_type = ? WHERE id = ?',
+                            (file_id, media_type, event_id))
+            self.db.commit()
+
+    def set_thumbnail(self, event_id, thumbnail):
+        with self.lock:
+            self.db.execute('UPDATE events SET thumbnail = ? WHERE id = ?', (thumbnail, event_id))
+            self.db.commit()
+
+    def cameras(self):
+        with self.lock:
+            return [row[0] for row in
+                    self.db.execute('SELECT DISTINCT camera FROM events WHERE camera IS NOT NULL').fetchall()]
+
+    def purge(self, before, vacuum=False):
+        with self.lock:
+            n_deleted = self.db.execute('DELETE FROM events WHERE timestamp < ?', (before,)).rowcount
+            self.db.commit()
+            if vacuum:
+                self.db.execute('VACUUM')
+            return n_deleted
+
+    def count(self, camera, since, until):
+        clause, params = EventIndex.where(camera, since, until)
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM events WHERE ' + clause, params).fetchone()[0]
+
+    def find(self, camera, since, until, offset, limit):
+        clause, params = EventIndex.where(camera, since, until)
+        with self.lock:
+            return self.db.execute('SELECT id, camera, timestamp, media_type FROM events WHERE ' + clause +
+                                   ' ORDER BY timestamp DESC LIMIT ? OFFSET ?',
+                                   params + [limit, offset]).fetchall()
+
+    def get(self, event_id):
+        with self.lock:
+            return self.db.execute('SELECT camera, timestamp, media_type, file_id, thumbnail '
+                                   'FROM events WHERE id = ?', (event_id,)).fetchone()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def camera_name(camera):
+    if camera in cameras:
+        return cameras[camera].get('name') or camera
+    return camera if camera else 'unbekannt'
+
+
 def send_msg_to_all(msg):
     if isinstance(msg, str):
         while len(msg) > 0:
@@ -67,52 +272,126 @@ def send_msg_to_all(msg):
             msg = msg[TELEGRAM_MAX_MESSAGE_SIZE:]
 
 
-def take_snapshot_thread():
+def fetch_snapshot(camera_id):
+    camera = cameras[camera_id]
+    health = camera_health[camera_id]
+    was_open = health.is_open()
+    t0 = time.monotonic()
+    try:
+        headers = urllib3.util.make_headers(basic_auth='{}:{}'.format(camera.get('username'),
+                                                                      camera.get('password'))) \
+            if camera.get('username') and camera.get('password') else None
+        response = http.request('GET', camera.get('snapshot_url'), headers=headers,
+                                timeout=snapshot_timeout,
+                                retries=urllib3.Retry(connect=0, read=0, redirect=3))
+        if response.status != 200 or not response.data:
+            raise urllib3.exceptions.HTTPError('HTTP-Status {}'.format(response.status))
+    except Exception as e:
+        # every acquire() must be balanced by record_success() or record_failure()
+        health.record_failure(e)
+        if not isinstance(e, (urllib3.exceptions.HTTPError, OSError)):
+            traceback.print_exc()
+        if health.is_open() and not was_open:
+            notify_camera_state(camera_id, 'Kamera "{}" ist nicht erreichbar: {}'.format(camera_name(camera_id), e))
+        return None, e
+    health.record_success(time.monotonic() - t0)
+    if was_open:
+        notify_camera_state(camera_id, 'Kamera "{}" ist wieder erreichbar.'.format(camera_name(camera_id)))
+    return response.data, None
+
+
+def notify_camera_state(camera_id, msg):
+    if verbose:
+        print('Camera {}: {}'.format(camera_id, msg))
+    try:
+        send_msg_to_all(msg)
+    except Exception:
+        traceback.print_exc()
+
+
+def send_snapshot(camera_id, chat_id, report_errors):
+    try:
+        data, error_msg = fetch_snapshot(camera_id)
+        if error_msg:
+            if report_errors:
+                bot.sendMessage(chat_id, 'Fehler beim Abrufen des Schnappschusses via {}: {}'
+                                .format(cameras[camera_id].get('snapshot_url'), error_msg))
+        else:
+            bot.sendPhoto(chat_id, ('snapshot.jpg', io.BytesIO(data)),
+                          caption='{} ({})'.format(camera_name(camera_id),
+                                                   datetime.datetime.now().strftime('%d.%m.%Y %H:%M:%S')))
+    except Exception as e:
+        print('Error while sending snapshot of camera {}:'.format(camera_id))
+        traceback.print_exc()
+        if report_errors:
+            try:
+                bot.sendMessage(chat_id, 'Fehler beim Senden des Schnappschusses von "{}": {}'
+                                .format(camera_name(camera_id), e))
+            except Exception:
+                traceback.print_exc()
 
-    def get_image_from_url(url, username, password):
-        error_msg = None
-        response = None
-        try:
-            http = urllib3.PoolManager()
-            headers = urllib3.util.make_headers(basic_auth='{}:{}'
-                                                .format(username, password)) if username and password else None
-            response = http.request('GET', url, headers=headers)
-        except urllib3.exceptions.HTTPError as e:
-            error_msg = e
-        return response, error_msg
 
+def call_when_done(futures, callback):
+    if len(futures) == 0:
+        callback()
+        return
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            finished = remaining[0] == 0
+        if finished:
+            callback()
+
+    for future in futures:
+        future.add_done_callback(done)
+
+
+def take_snapshot_thread():
     while True:
         task = snapshot_queue.get()
         if task is None:
             break
-        for camera in task['cameras']:
-            if camera.get('snapshot_url'):
-                bot.sendChatAction(task['chat_id'], action='upload_photo')
-                response, error_msg = \
-                    get_image_from_url(camera.get('snapshot_url'),
-                                       camera.get('username'),
-                                       camera.get('password'))
-                if error_msg:
+        report_errors = task.get('report_errors', True)
+        futures = []
+        try:
+            for camera_id in task['camera_ids']:
+                health = camera_health.get(camera_id)
+                if health is None:
+                    continue
+                if not report_errors and health.is_busy():
+                    continue
+                if health.acquire():
+                    futures.append(camera_executor.submit(send_snapshot, camera_id, task['chat_id'], report_errors))
+                elif report_errors:
                     bot.sendMessage(task['chat_id'],
-                                    'Fehler beim Abrufen des Schnappschusses via {}: {}'
-                                    .format(camera.get('snapshot_url'), error_msg))
-                elif response and response.data:
-                    _, photo_filename = mkstemp(prefix='snapshot-', suffix='.jpg')
-                    f = open(photo_filename, 'wb+')
-                    f.write(response.data)
-                    f.close()
-                    bot.sendPhoto(task['chat_id'],
-                                  open(photo_filename, 'rb'),
-                                  caption=datetime.datetime.now().strftime('%d.%m.%Y %H:%M:%S'))
-                    os.remove(photo_filename)
-        snapshot_queue.task_done()
-        if 'callback' in task and callable(task['callback']):
-            task['callback']()
+                                    'Kamera "{}" ist derzeit nicht erreichbar. Nächster Versuch um {}.'
+                                    .format(camera_name(camera_id),
+                                            datetime.datetime.fromtimestamp(health.open_until or time.time())
+                                            .strftime('%H:%M:%S')))
+            if len(futures) > 0:
+                bot.sendChatAction(task['chat_id'], action='upload_photo')
+            if 'callback' in task and callable(task['callback']):
+                call_when_done(futures, task['callback'])
+        except Exception:
+            print('Error while dispatching snapshot task:')
+            traceback.print_exc()
+        finally:
+            snapshot_queue.task_done()
 
 
 def make_snapshot(chat_id):
-    snapshot_queue.put({'cameras': cameras.values(),
-                        'chat_id': chat_id})
+    snapshot_queue.put({'camera_ids': list(cameras.keys()),
+                        'chat_id': chat_id,
+                        'report_errors': False})
+
+
+def probe_cameras():
+    for camera_id, health in camera_health.items():
+        if health.probe_due() and not health.is_busy() and health.acquire():
+            camera_executor.submit(fetch_snapshot, camera_id)
 
 
 def process_text_thread():
@@ -138,9 +417,11 @@ def process_document_thread():
         task = document_queue.get()
         if task is None:
             break
+        file_id = None
         for user in authorized_users:
-            bot.sendDocument(user, open(task['src_filename'], 'rb'),
-                             caption=datetime.datetime.now().strftime('%d.%m.%Y %H:%M:%S'))
+            sent = bot.sendDocument(user, file_id or open(task['src_filename'], 'rb'),
+                                    caption=datetime.datetime.now().strftime('%d.%m.%Y %H:%M:%S'))
+            file_id = file_id or index_sent_file(task, sent, 'document')
         os.remove(task['src_filename'])
 
 
@@ -165,10 +446,13 @@ def process_video_thread():
         if verbose:
             print('Started {}'.format(' '.join(cmd)))
         subprocess.call(cmd, shell=False)
+        index_thumbnail(task, dst_video_filename, 'video')
+        file_id = None
         for user in authorized_users:
-            bot.sendVideo(user, open(dst_video_filename, 'rb'),
-                          caption='{} ({})'.format(os.path.basename(task['src_filename']),
-                                                   datetime.datetime.now().strftime('%d.%m.%Y %H:%M:%S')))
+            sent = bot.sendVideo(user, file_id or open(dst_video_filename, 'rb'),
+                                 caption='{} ({})'.format(os.path.basename(task['src_filename']),
+                                                          datetime.datetime.now().strftime('%d.%m.%Y %H:%M:%S')))
+            file_id = file_id or index_sent_file(task, sent, 'video')
         print('Removing converted video file: {}'.format(dst_video_filename))
         os.remove(dst_video_filename)
         print('Removing original video file: {}'.format(task['src_filename']))
@@ -176,31 +460,63 @@ def process_video_thread():
         video_queue.task_done()
 
 
-def process_voice_thread():
-    while True:
-        task = voice_queue.get()
-        if task is None:
-            break
-        _, voice_filename = mkstemp(prefix='voice-', suffix='.oga')
-        _, converted_audio_filename = mkstemp(prefix='converted-audio-', suffix='.wav')
-        bot.sendChatAction(task['chat_id'], action='upload_audio')
-        bot.download_file(task['file_id'], voice_filename)
+def decode_voice(file_id):
+    fd, voice_filename = mkstemp(prefix='voice-', suffix='.oga')
+    os.close(fd)
+    try:
+        bot.download_file(file_id, voice_filename)
+        frequency, _, channels = pygame.mixer.get_init()
         cmd = [path_to_ffmpeg,
                '-y',
                '-loglevel', 'panic',
                '-i', voice_filename,
+               '-f', 's16le',
                '-codec:a', 'pcm_s16le',
-               converted_audio_filename]
+               '-ar', str(frequency),
+               '-ac', str(channels),
+               '-']
         if verbose:
             print('Started {}'.format(' '.join(cmd)))
-        subprocess.call(cmd, shell=False)
-        voice = pygame.mixer.Sound(converted_audio_filename)
-        voice.set_volume(audio_volume)
-        voice.play()
-        os.remove(converted_audio_filename)
+        return subprocess.run(cmd, shell=False, stdout=subprocess.PIPE).stdout
+    finally:
         os.remove(voice_filename)
-        bot.sendMessage(task['chat_id'], 'Sprachnachricht wurde abgespielt.')
-        voice_queue.task_done()
+
+
+def play_voice(task):
+    voice = voice_cache.get(task['file_unique_id'])
+    if voice is None:
+        bot.sendChatAction(task['chat_id'], action='upload_audio')
+        pcm = decode_voice(task['file_id'])
+        if len(pcm) == 0:
+            bot.sendMessage(task['chat_id'], 'Sprachnachricht konnte nicht dekodiert werden.')
+            return
+        voice = pygame.mixer.Sound(buffer=pcm)
+        voice_cache.put(task['file_unique_id'], voice, len(pcm))
+    elif verbose:
+        print('Playing cached voice message {}'.format(task['file_unique_id']))
+    voice_channel.set_volume(audio_volume)
+    voice_channel.play(voice)
+    while voice_channel.get_busy():
+        time.sleep(0.1)
+    bot.sendMessage(task['chat_id'], 'Sprachnachricht wurde abgespielt.')
+
+
+def process_voice_thread():
+    while True:
+        task = voice_queue.get()
+        if task is None:
+            break
+        try:
+            play_voice(task)
+        except Exception as e:
+            print('Error while playing voice message:')
+            traceback.print_exc()
+            try:
+                bot.sendMessage(task['chat_id'], 'Sprachnachricht konnte nicht abgespielt werden: {}'.format(e))
+            except Exception:
+                traceback.print_exc()
+        finally:
+            voice_queue.task_done()
 
 
 def process_photo_thread():
@@ -221,12 +537,135 @@ def process_photo_thread():
             im.close()
         if verbose:
             print('Sending photo {} ...'.format(dst_photo_filename))
+        file_id = None
         for user in authorized_users:
-            bot.sendPhoto(user, open(dst_photo_filename, 'rb'),
-                          caption=datetime.datetime.now().strftime('%d.%m.%Y %H:%M:%S'))
+            sent = bot.sendPhoto(user, file_id or open(dst_photo_filename, 'rb'),
+                                 caption=datetime.datetime.now().strftime('%d.%m.%Y %H:%M:%S'))
+            file_id = file_id or index_sent_file(task, sent, 'photo')
         os.remove(dst_photo_filename)
 
 
+def index_sent_file(task, sent, media_type):
+    """ Stores the file_id of a file sent to Telegram in the event index. Returns the file_id
+    if it can be used to send the file again as `media_type`, otherwise None. """
+    # Telegram may turn e.g. a silent video into an animation, which has no `video` key
+    for kind in [media_type, 'animation', 'document']:
+        media = sent.get(kind) if isinstance(sent, dict) else None
+        if isinstance(media, list):  # photos come in several sizes
+            media = media[-1] if len(media) > 0 else None
+        if isinstance(media, dict) and media.get('file_id'):
+            break
+    else:
+        return None
+    if task.get('event_id') is not None:
+        try:
+            event_index.set_file_id(task['event_id'], media['file_id'], kind)
+        except sqlite3.Error as e:
+            print('Cannot store file_id in event index: {}'.format(e))
+    return media['file_id'] if kind == media_type else None
+
+
+def index_thumbnail(task, src_filename, media_type):
+    if task.get('event_id') is None:
+        return
+    thumbnail = make_thumbnail(src_filename, media_type)
+    if thumbnail is None:
+        return
+    try:
+        event_index.set_thumbnail(task['event_id'], thumbnail)
+    except sqlite3.Error as e:
+        print('Cannot store thumbnail in event index: {}'.format(e))
+
+
+def process_thumbnail_thread():
+    """ Makes thumbnails of videos that are indexed but not sent, and removes them afterwards """
+    while True:
+        task = thumbnail_queue.get()
+        if task is None:
+            break
+        index_thumbnail(task, task['src_filename'], task['media_type'])
+        print('Removing {}'.format(task['src_filename']))
+        os.remove(task['src_filename'])
+        thumbnail_queue.task_done()
+
+
+def make_thumbnail(src_filename, media_type):
+    try:
+        if media_type == 'photo':
+            im = Image.open(src_filename)
+        elif media_type == 'video' and type(path_to_ffmpeg) is str:
+            cmd = [path_to_ffmpeg,
+                   '-loglevel', 'panic',
+                   '-i', src_filename,
+                   '-frames:v', '1',
+                   '-f', 'image2pipe',
+                   '-codec:v', 'mjpeg',
+                   '-']
+            frame = subprocess.run(cmd, shell=False, stdout=subprocess.PIPE, timeout=30).stdout
+            im = Image.open(io.BytesIO(frame))
+        else:
+            return None
+        im.thumbnail((THUMBNAIL_DIMENSION, THUMBNAIL_DIMENSION), Image.BILINEAR)
+        thumbnail = io.BytesIO()
+        im.convert('RGB').save(thumbnail, format='JPEG', quality=75)
+        im.close()
+        return thumbnail.getvalue()
+    except (OSError, ValueError, subprocess.TimeoutExpired) as e:
+        if verbose:
+            print('Cannot create thumbnail of {}: {}'.format(src_filename, e))
+        return None
+
+
+def camera_from_path(filename):
+    components = os.path.relpath(filename, upload_folder).split(os.sep)
+    return components[0] if len(components) > 1 else None
+
+
+def resolve_camera(name):
+    """ Maps a camera key or display name to the upload subdirectory the camera's events are indexed under """
+    if name in cameras:
+        return name
+    for camera_id, camera in cameras.items():
+        if (camera.get('name') or '').lower() == name.lower():
+            return camera_id
+    known = event_index.cameras()
+    if name in known:
+        return name
+    raise ValueError('Unbekannte Kamera "{}". Bekannt sind: {}'
+                     .format(name, ', '.join(sorted(set(camera_name(c) for c in list(cameras.keys()) + known)))))
+
+
+def parse_history_args(args):
+    now = datetime.datetime.now()
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    camera_words = []
+    since = now - datetime.timedelta(days=1)
+    until = now
+    for arg in args:
+        m = re.fullmatch(r'(\d+)([mhd])', arg.lower())
+        if m:
+            unit = {'m': 'minutes', 'h': 'hours', 'd': 'days'}[m.group(2)]
+            try:
+                since = now - datetime.timedelta(**{unit: int(m.group(1))})
+            except OverflowError:
+                raise ValueError('Zeitraum "{}" ist zu groß.'.format(arg))
+            until = now
+        elif arg.lower() == 'heute':
+            since, until = midnight, now
+        elif arg.lower() == 'gestern':
+            since, until = midnight - datetime.timedelta(days=1), midnight
+        elif re.fullmatch(r'[\d.:/-]+', arg):
+            try:
+                since = datetime.datetime.strptime(arg, '%d.%m.%Y')
+            except ValueError:
+                raise ValueError('Ungültiges Datum "{}" (erwartet wird TT.MM.JJJJ).'.format(arg))
+            until = since + datetime.timedelta(days=1)
+        else:
+            camera_words.append(arg)
+    camera = resolve_camera(' '.join(camera_words)) if len(camera_words) > 0 else None
+    return camera, since.timestamp(), until.timestamp()
+
+
 def garbage_collector():
     print('Garbage collection ...')
     
@@ -242,6 +681,12 @@ def garbage_collector():
         for _ in subdirs:
             pass
 
+    if event_retention_days:
+        before = datetime.datetime.now() - datetime.timedelta(days=event_retention_days)
+        n_deleted = event_index.purge(before.timestamp(), vacuum=datetime.date.today().weekday() == 6)
+        if verbose:
+            print('Removed {} events older than {} days from the event index.'.format(n_deleted, event_retention_days))
+
 
 def file_write_ok(filename, timeout_secs=5):
     CheckIntervalMS = 100
@@ -276,10 +721,24 @@ class UploadDirectoryEventHandler(FileSystemEventHandler):
             else:
                 self.process_document(event.src_path)
 
+    @staticmethod
+    def index_event(src_filename, media_type):
+        camera = camera_from_path(src_filename)
+        if verbose and camera not in cameras:
+            print('Warning: {} is not in a subdirectory named after a camera key.'.format(src_filename))
+        # video thumbnails are made in the video or thumbnail processor so that ffmpeg doesn't block the observer
+        thumbnail = make_thumbnail(src_filename, media_type) if media_type == 'photo' else None
+        try:
+            return event_index.add(camera, media_type, os.path.basename(src_filename), thumbnail)
+        except sqlite3.Error as e:
+            print('Cannot add {} to event index: {}'.format(src_filename, e))
+            return None
+
     def process_text(self, src_text_filename):
         if file_write_ok(src_text_filename):
             if verbose:
                 print('New text file detected: {}'.format(src_text_filename))
+            self.index_event(src_text_filename, 'text')
             if alerting_on and do_send_text:
                 text_queue.put({'src_filename': src_text_filename})
             else:
@@ -289,8 +748,10 @@ class UploadDirectoryEventHandler(FileSystemEventHandler):
         if file_write_ok(src_document_filename):
             if verbose:
                 print('New document detected: {}'.format(src_document_filename))
+            event_id = self.index_event(src_document_filename, 'document')
             if alerting_on and do_send_documents:
-                document_queue.put({'src_filename': src_document_filename})
+                document_queue.put({'src_filename': src_document_filename,
+                                    'event_id': event_id})
             else:
                 os.remove(src_document_filename)
 
@@ -298,8 +759,10 @@ class UploadDirectoryEventHandler(FileSystemEventHandler):
         if file_write_ok(src_photo_filename):
             if verbose:
                 print('New photo file detected: {}'.format(src_photo_filename))
+            event_id = self.index_event(src_photo_filename, 'photo')
             if alerting_on and do_send_photos:
-                photo_queue.put({'src_filename': src_photo_filename})
+                photo_queue.put({'src_filename': src_photo_filename,
+                                 'event_id': event_id})
             else:
                 os.remove(src_photo_filename)
 
@@ -307,11 +770,14 @@ class UploadDirectoryEventHandler(FileSystemEventHandler):
         if file_write_ok(src_video_filename):
             if verbose:
                 print('New video file detected: {}'.format(src_video_filename))
+            event_id = self.index_event(src_video_filename, 'video')
             if alerting_on and do_send_videos and type(path_to_ffmpeg) is str:
-                video_queue.put({'src_filename': src_video_filename})
+                video_queue.put({'src_filename': src_video_filename,
+                                 'event_id': event_id})
             else:
-                print('Removing {}'.format(src_video_filename))
-                os.remove(src_video_filename)
+                thumbnail_queue.put({'src_filename': src_video_filename,
+                                     'media_type': 'video',
+                                     'event_id': event_id})
 
 
 class ChatUser(telepot.helper.ChatHandler):
@@ -325,6 +791,7 @@ class ChatUser(telepot.helper.ChatHandler):
     def __init__(self, *args, **kwargs):
         super(ChatUser, self).__init__(*args, **kwargs)
         self.snapshot_job = None
+        self.history_queries = OrderedDict()
 
     def open(self, initial_msg, seed):
         _, _, chat_id = telepot.glance(initial_msg)
@@ -358,6 +825,64 @@ class ChatUser(telepot.helper.ChatHandler):
         keyboard = InlineKeyboardMarkup(inline_keyboard=[kbd])
         self.sender.sendMessage('Schnappschuss anzeigen von:', reply_markup=keyboard)
 
+    def send_history_page(self, query, offset, msg_identifier=None):
+        camera, since, until = query
+        total = event_index.count(camera, since, until)
+        if total == 0:
+            if msg_identifier:
+                self.bot.editMessageText(msg_identifier, 'Keine Ereignisse im gewählten Zeitraum gefunden.')
+            else:
+                self.sender.sendMessage('Keine Ereignisse im gewählten Zeitraum gefunden.')
+            return
+        offset = max(0, min(offset, (total - 1) // HISTORY_PAGE_SIZE * HISTORY_PAGE_SIZE))
+        icons = {'photo': chr(0x1F4F7), 'video': chr(0x1F3A5), 'animation': chr(0x1F3A5), 'text': chr(0x1F4DD), 'document': chr(0x1F4C4)}
+        kbd = [[InlineKeyboardButton(text='{} {} {}'.format(icons.get(media_type, ''),
+                                                            datetime.datetime.fromtimestamp(timestamp)
+                                                            .strftime('%d.%m. %H:%M:%S'),
+                                                            camera_name(event_camera)),
+                                     callback_data='history:show:{}'.format(event_id))]
+               for event_id, event_camera, timestamp, media_type
+               in event_index.find(camera, since, until, offset, HISTORY_PAGE_SIZE)]
+        nav = []
+        if offset > 0:
+            nav.append(InlineKeyboardButton(text=chr(0x25C0) + ' Neuere',
+                                            callback_data='history:page:{}'.format(max(0, offset - HISTORY_PAGE_SIZE))))
+        if offset + HISTORY_PAGE_SIZE < total:
+            nav.append(InlineKeyboardButton(text='Ältere ' + chr(0x25B6),
+                                            callback_data='history:page:{}'.format(offset + HISTORY_PAGE_SIZE)))
+        if len(nav) > 0:
+            kbd.append(nav)
+        keyboard = InlineKeyboardMarkup(inline_keyboard=kbd)
+        text = 'Ereignisse {}–{} von {}:'.format(offset + 1, min(offset + HISTORY_PAGE_SIZE, total), total)
+        if msg_identifier:
+            self.bot.editMessageText(msg_identifier, text, reply_markup=keyboard)
+        else:
+            sent = self.sender.sendMessage(text, reply_markup=keyboard)
+            # remember the query per result message, so that paging in older results keeps working
+            self.history_queries[sent['message_id']] = query
+            while len(self.history_queries) > HISTORY_MAX_QUERIES:
+                self.history_queries.popitem(last=False)
+
+    def send_event(self, event_id):
+        event = event_index.get(event_id)
+        if event is None:
+            self.sender.sendMessage('Ereignis nicht gefunden.')
+            return
+        camera, timestamp, media_type, file_id, thumbnail = event
+        caption = '{} ({})'.format(camera_name(camera),
+                                   datetime.datetime.fromtimestamp(timestamp).strftime('%d.%m.%Y %H:%M:%S'))
+        if file_id:
+            if media_type == 'photo':
+                self.sender.sendPhoto(file_id, caption=caption)
+            elif media_type == 'video':
+                self.sender.sendVideo(file_id, caption=caption)
+            else:
+                self.sender.sendDocument(file_id, caption=caption)
+        elif thumbnail:
+            self.sender.sendPhoto(('thumbnail.jpg', io.BytesIO(thumbnail)), caption=caption + ' (Vorschau)')
+        else:
+            self.sender.sendMessage('Zu diesem Ereignis ({}) ist kein Medium gespeichert.'.format(caption))
+
     def send_main_menu(self):
         global alerting_on
         kbd = [
@@ -378,7 +903,7 @@ class ChatUser(telepot.helper.ChatHandler):
         if cameras.get(query_data):
             bot.answerCallbackQuery(query_id,
                                     text='Schnappschuss von deiner Kamera "{}"'.format(query_data))
-            snapshot_queue.put({'cameras': [cameras[query_data]],
+            snapshot_queue.put({'camera_ids': [query_data],
                                 'chat_id': from_id,
                                 'callback': lambda: self.send_snapshot_menu()})
         elif query_data == 'disable':
@@ -392,6 +917,17 @@ class ChatUser(telepot.helper.ChatHandler):
         elif query_data == 'snapshot':
             self.bot.answerCallbackQuery(query_id)
             self.send_snapshot_menu()
+        elif query_data.startswith('history:show:'):
+            self.bot.answerCallbackQuery(query_id)
+            self.send_event(int(query_data.split(':')[2]))
+        elif query_data.startswith('history:page:'):
+            query = self.history_queries.get(msg['message']['message_id'])
+            if query is None:
+                self.bot.answerCallbackQuery(query_id, text='Abfrage abgelaufen. Bitte /history erneut eingeben.')
+            else:
+                self.bot.answerCallbackQuery(query_id)
+                self.send_history_page(query, int(query_data.split(':')[2]),
+                                       telepot.message_identifier(msg['message']))
 
     def on_chat_message(self, msg):
         global scheduler, settings, alerting_on
@@ -451,6 +987,23 @@ class ChatUser(telepot.helper.ChatHandler):
                                 self.sender.sendMessage('Schnappschussintervall ist derzeit auf '
                                                         '{} Sekunden eingestellt.'
                                                         .format(settings[chat_id]['snapshot']['interval']))
+            elif msg_text.startswith('/cameras'):
+                if len(cameras) == 0:
+                    self.sender.sendMessage('Keine Kameras konfiguriert.')
+                else:
+                    self.sender.sendMessage('\n'.join('{}: {}'.format(camera_name(camera_id),
+                                                                       camera_health[camera_id].describe()
+                                                                       if camera_id in camera_health
+                                                                       else 'kein Schnappschuss-URL')
+                                                       for camera_id in cameras.keys()))
+            elif msg_text.startswith('/history'):
+                try:
+                    query = parse_history_args(msg_text.split()[1:])
+                except ValueError as e:
+                    self.sender.sendMessage('{}\n\nAufruf: /history [kamera] [zeitraum], '
+                                            'z.B. "/history Haustür gestern" oder "/history 12h"'.format(e))
+                else:
+                    self.send_history_page(query, 0)
             elif msg_text.startswith('/enable') or \
                     any(cmd in msg_text.lower() for cmd in ['on', 'go', '1', 'ein']):
                 alerting_on = True
@@ -471,6 +1024,10 @@ class ChatUser(telepot.helper.ChatHandler):
                                         "Schnappschüsse von den Kameras abgerufen und angezeigt werden sollen\n"
                                         "/snapshot `interval` `secs` Schnappschussintervall auf `secs` Sekunden "
                                         "setzen (`0` für aus)\n"
+                                        "/cameras Erreichbarkeit der Kameras anzeigen\n"
+                                        "/history `[kamera]` `[zeitraum]` Ereignisse auflisten; Kamera per Schlüssel oder Name; "
+                                        "Zeitraum z.B. `30m`, `12h`, `7d`, `heute`, `gestern` oder `18.10.2018` "
+                                        "(Standard: letzte 24 Stunden)\n"
                                         "/uptime Uptime anzeigen\n"
                                         "/start den Bot (neu)starten\n",
                                         parse_mode='Markdown')
@@ -481,6 +1038,7 @@ class ChatUser(telepot.helper.ChatHandler):
         elif content_type == 'voice':
             if audio_on:
                 voice_queue.put({'file_id': msg['voice']['file_id'],
+                                 'file_unique_id': msg['voice'].get('file_unique_id', msg['voice']['file_id']),
                                  'chat_id': chat_id})
             else:
                 self.sender.sendMessage('Keine Sprachausgabe aktiv.')
@@ -495,6 +1053,8 @@ text_queue = None
 document_queue = None
 video_queue = None
 voice_queue = None
+voice_channel = None
+voice_cache = None
 photo_queue = None
 snapshooter = None
 text_processor = None
@@ -502,6 +1062,14 @@ document_processor = None
 video_processor = None
 voice_processor = None
 photo_processor = None
+event_index = None
+thumbnail_queue = None
+thumbnail_processor = None
+event_retention_days = None
+camera_health = {}
+camera_executor = None
+http = None
+snapshot_timeout = None
 authorized_users = None
 upload_folder = None
 cameras = None
@@ -513,6 +1081,7 @@ alerting_on = True
 copy_to = None
 audio_on = None
 audio_volume = 1.0
+audio_cache_mb = 32
 do_send_videos = None
 do_send_photos = None
 do_send_text = None
@@ -530,8 +1099,11 @@ def main():
         do_send_text, text_queue, max_text_file_size, \
         do_send_documents, document_queue, \
         do_send_videos, video_queue, video_processor, \
-        audio_on, audio_volume, voice_queue, voice_processor, upload_folder, \
-        do_send_photos, photo_queue, photo_processor
+        audio_on, audio_volume, audio_cache_mb, voice_queue, voice_processor, \
+        voice_channel, voice_cache, upload_folder, \
+        do_send_photos, photo_queue, photo_processor, event_index, event_retention_days, \
+        thumbnail_queue, thumbnail_processor, \
+        camera_health, camera_executor, http, snapshot_timeout
     config_filename = 'smarthomebot-config.json'
     shelf = shelve.open('.smarthomebot.shelf')
     if APPNAME in shelf.keys():
@@ -558,7 +1130,18 @@ def main():
         print('Error: config file doesn\'t define any `cameras`')
         return
     timeout_secs = config.get('timeout_secs', 10*60)
+    snapshot_timeout_secs = config.get('snapshot_timeout_secs', 5)
+    snapshot_timeout = urllib3.Timeout(connect=snapshot_timeout_secs, read=snapshot_timeout_secs)
+    probe_interval_secs = config.get('camera_probe_interval_secs', 60)
+    camera_health = {camera_id: CameraHealth(probe_interval_secs)
+                     for camera_id, camera in cameras.items() if camera.get('snapshot_url')}
+    max_workers = max(4, 2 * len(camera_health))
+    http = urllib3.PoolManager(num_pools=max(1, len(camera_health)), maxsize=max_workers)
+    camera_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
     upload_folder = config.get('image_folder', '/home/ftp-upload')
+    event_index = EventIndex(config.get('event_db', '.smarthomebot-events.sqlite'))
+    event_retention_days = config.get('event_retention_days', 15)
+    thumbnail_queue = queue.Queue()
     event_handler = UploadDirectoryEventHandler(ignore_directories=True)
     observer = Observer()
     observer.schedule(event_handler, upload_folder, recursive=True)
@@ -569,6 +1152,8 @@ def main():
         print('ERROR: Cannot start observer. Make sure the folder {:s} exists and is writable for {:s}.'
               .format(upload_folder, pwd.getpwuid(os.getuid()).pw_name))
         return
+    thumbnail_processor = threading.Thread(target=process_thumbnail_thread)
+    thumbnail_processor.start()
     path_to_ffmpeg = config.get('path_to_ffmpeg')
     max_photo_size = config.get('max_photo_size', TELEGRAM_MAX_PHOTO_DIMENSION)
     verbose = config.get('verbose', False)
@@ -590,6 +1175,7 @@ def main():
     do_send_documents = config.get('send_documents', False)
     audio_on = config.get('audio', {}).get('enabled', False)
     audio_volume = config.get('audio', {}).get('volume', 1.0)
+    audio_cache_mb = config.get('audio', {}).get('cache_mb', 32)
     bot = telepot.DelegatorBot(telegram_bot_token, [
         include_callback_query_chat_id(pave_event_space())(per_chat_id_in(authorized_users, types='private'),
                                                            create_open,
@@ -623,10 +1209,14 @@ def main():
         video_processor.start()
         if verbose:
             print('Enabled video processing.')
+    if audio_on and type(path_to_ffmpeg) is not str:
+        print('WARNING: Audio output requires `path_to_ffmpeg` to be set. Audio is disabled.')
+        audio_on = False
     if audio_on:
         try:
             pygame.mixer.pre_init(frequency=TELEGRAM_AUDIO_BITRATE, size=-16, channels=2, buffer=4096)
             pygame.mixer.init()
+            pygame.mixer.set_reserved(1)
         except:
             print("\nWARNING: Cannot initialize audio.\n"
                   "*** See above warnings for details.\n"
@@ -634,6 +1224,8 @@ def main():
                   "*** SurveillanceBot config file.\n")
             audio_on = False
         else:
+            voice_channel = pygame.mixer.Channel(0)
+            voice_cache = SoundCache(audio_cache_mb * 1024 * 1024)
             voice_queue = queue.Queue()
             voice_processor = threading.Thread(target=process_voice_thread)
             voice_processor.start()
@@ -643,6 +1235,7 @@ def main():
         print('Monitoring {} ...'.format(upload_folder))
     scheduler.start()
     scheduler.add_job(garbage_collector, 'cron', hour=0)
+    scheduler.add_job(probe_cameras, 'interval', seconds=CAMERA_PROBE_TICK_SECS)
     try:
         bot.message_loop(run_forever='Bot listening ... (Press Ctrl+C to exit.)')
     except KeyboardInterrupt:
@@ -658,6 +1251,9 @@ def main():
 
     snapshot_queue.put(None)
     snapshooter.join()
+    thumbnail_queue.put(None)
+    thumbnail_processor.join()
+    camera_executor.shutdown()
     if do_send_videos:
         video_queue.put(None)
         video_processor.join()
@@ -673,6 +1269,7 @@ def main():
     if audio_on:
         voice_queue.put(None)
         voice_processor.join()
+    event_index.close()
 
 if __name__ == '__main__':
     main()